@@ -1,71 +1,109 @@
 import asyncio
+import signal
 import struct
 from enum import Enum
-from functools import partial
-from typing import Optional, Union
+from typing import Callable, List, Optional, Tuple, Union
 
 from bleak import BleakError, BleakScanner, BleakClient
 
-from linak_ble_controller.config import UserConfig
-from linak_ble_controller.helper import UnitConverter
+from linak_ble_controller.config import FrozenConfig
+from linak_ble_controller.helper import UnitConverter, print_status
+
+
+# Plain strings so GATT operations don't go through enum member lookups
+UUID_HEIGHT = "99fa0021-338a-1024-8a49-009c0215f78a"
+UUID_COMMAND = "99fa0002-338a-1024-8a49-009c0215f78a"
+UUID_REFERENCE_INPUT = "99fa0031-338a-1024-8a49-009c0215f78a"
 
 
 class GattCharacteristics(str, Enum):
-    UUID_HEIGHT = "99fa0021-338a-1024-8a49-009c0215f78a"
-    UUID_COMMAND = "99fa0002-338a-1024-8a49-009c0215f78a"
-    UUID_REFERENCE_INPUT = "99fa0031-338a-1024-8a49-009c0215f78a"
+    UUID_HEIGHT = UUID_HEIGHT
+    UUID_COMMAND = UUID_COMMAND
+    UUID_REFERENCE_INPUT = UUID_REFERENCE_INPUT
+
+
+# Precompiled codecs for the raw characteristic values
+_HEIGHT_SPEED = struct.Struct("<Hh")
+_U16 = struct.Struct("<H")
+
+_FMT = "Height: {:4.0f}mm Speed: {:2.0f}mm/s".format
+
+# Seconds between reference input refreshes, the desk stops if it isn't refreshed while moving
+_REFRESH_INTERVAL = 0.2
+# Seconds a move may go without any movement before it is treated as already at the target
+_START_GRACE = 1
+
+
+def _make_notify_cb(raw_to_mm, raw_to_speed, log):
+    """Build a height listener with everything it needs bound as locals"""
+
+    def callback(height, speed):
+        log(_FMT(raw_to_mm(height), raw_to_speed(speed)))
+
+    return callback
 
 
 class BluetoothAdapter:
-    def __init__(self, unit_converter: UnitConverter, config: UserConfig):
+    __slots__ = (
+        "unit_converter",
+        "config",
+        "stop_command",
+        "wake_command",
+        "client",
+        "last_state",
+        "_height_listeners",
+    )
+
+    def __init__(self, unit_converter: UnitConverter, config: FrozenConfig):
         self.unit_converter = unit_converter
         self.config = config
 
-        self.stop_command = bytearray(struct.pack("<H", 255))
-        self.wake_command = bytearray(struct.pack("<H", 254))
+        self.stop_command = _U16.pack(255)
+        self.wake_command = _U16.pack(254)
 
         self.client: Optional[BleakClient] = None
 
-    async def safe_read_gatt(self, char: GattCharacteristics):
-        return await self.client.read_gatt_char(str(char.value))
+        # Latest (height, speed) reported by the desk, kept up to date by a subscription made on connect
+        self.last_state: Optional[Tuple[int, int]] = None
+        self._height_listeners: List[Callable[[int, int], None]] = []
 
-    async def safe_write_gatt(self, char: GattCharacteristics, data):
-        return await self.client.write_gatt_char(str(char.value), data)
+    async def safe_read_gatt(self, char: str):
+        return await self.client.read_gatt_char(char)
 
-    async def get_height_speed(self):
-        return struct.unpack("<Hh", await self.safe_read_gatt(GattCharacteristics.UUID_HEIGHT))
+    async def safe_write_gatt(self, char: str, data, response: bool = True):
+        return await self.client.write_gatt_char(char, data, response=response)
 
-    def get_height_data_from_notification(self, data):
-        height, speed = struct.unpack("<Hh", data)
-        print(
-            "Height: {:4.0f}mm Speed: {:2.0f}mm/s".format(
-                self.unit_converter.raw_to_mm(height), self.unit_converter.raw_to_speed(speed)
-            )
-        )
+    async def get_height_speed(self):
+        return _HEIGHT_SPEED.unpack(await self.safe_read_gatt(UUID_HEIGHT))
 
     async def wake_up(self):
-        await self.safe_write_gatt(GattCharacteristics.UUID_COMMAND, self.wake_command)
+        await self.safe_write_gatt(UUID_COMMAND, self.wake_command)
 
-    async def move_to_target(self, target):
-        encoded_target = bytearray(struct.pack("<H", int(target)))
-        await self.safe_write_gatt(GattCharacteristics.UUID_REFERENCE_INPUT, encoded_target)
+    async def _write_target_bytes(self, buf: bytes, response: bool = True):
+        await self.safe_write_gatt(UUID_REFERENCE_INPUT, buf, response=response)
 
     async def stop(self):
         try:
-            await self.safe_write_gatt(GattCharacteristics.UUID_COMMAND, self.stop_command)
+            await self.safe_write_gatt(UUID_COMMAND, self.stop_command)
         except BleakError:
             # This seems to result in an error on Raspberry Pis, but it does not affect movement
             # bleak.exc.BleakDBusError: [org.bluez.Error.NotPermitted] Write acquired
             pass
 
-    async def subscribe(self, uuid: GattCharacteristics, callback):
+    def _persistent_cb(self, _, data):
+        """Record every height notification and pass it on to the registered listeners"""
+        self.last_state = height, speed = _HEIGHT_SPEED.unpack_from(data)
+        for listener in self._height_listeners:
+            listener(height, speed)
+
+    async def subscribe(self, uuid: str, callback):
         """Listen for notifications on a characteristic"""
-        await self.client.start_notify(str(uuid.value), callback)
+        await self.client.start_notify(uuid, callback)
 
-    async def unsubscribe(self, uuid: GattCharacteristics):
+    async def unsubscribe(self, uuid: str):
         """Stop listening for notifications on a characteristic"""
         try:
-            await self.client.stop_notify(str(uuid.value))
+            await self.client.stop_notify(uuid)
         except KeyError:
             # This happens on Windows, I don't know why
             pass
@@ -76,56 +114,91 @@ class BluetoothAdapter:
         specified
         """
 
-        print("Scanning\r", end="")
+        print_status("Scanning")
         devices = await BleakScanner().discover(
-            device=self.config["adapter_name"], timeout=self.config["scan_timeout"]
+            device=self.config.adapter_name, timeout=self.config.scan_timeout
         )
-        print("Found {} devices using {}".format(len(devices), self.config["adapter_name"]))
+        print("Found {} devices using {}".format(len(devices), self.config.adapter_name))
         for device in devices:
             print(device)
 
         return devices
 
-    async def move_to(self, target, log=print):
+    async def move_to(self, target, log=print, initial_height=None):
         """
-        Move the desk to a specified height
+        Move the desk to a specified height and return the height it came to rest at.
+        Defaults to starting from the last reported height.
         """
 
-        initial_height, speed = struct.unpack(
-            "<Hh", await self.safe_read_gatt(GattCharacteristics.UUID_HEIGHT)
-        )
+        if initial_height is None:
+            initial_height = self.last_state[0]
 
         if initial_height == target:
-            return
-
-        await self.wake_up()
-        # await self.stop()
+            return initial_height
 
+        raw_to_mm = self.unit_converter.raw_to_mm
+        raw_to_speed = self.unit_converter.raw_to_speed
+        loop = asyncio.get_running_loop()
+        done = loop.create_future()
         current_height = initial_height
+        moving = False
+
+        def callback(height, speed):
+            nonlocal current_height, moving
+            current_height = height
+            log(_FMT(raw_to_mm(current_height), raw_to_speed(speed)))
+
+            # Ignore a zero speed before the desk started moving, otherwise we would stop right away
+            moving = moving or speed != 0
+            if not done.done() and (current_height == target or (moving and speed == 0)):
+                done.set_result(current_height)
+
+        async def push_target():
+            # Refreshes don't need to wait for an acknowledgement, a lost one is repeated anyway
+            buf = _U16.pack(int(target))
+            response = True
+            grace_deadline = loop.time() + _START_GRACE
+            while not done.done():
+                await self._write_target_bytes(buf, response)
+                response = False
+                await asyncio.wait([done], timeout=_REFRESH_INTERVAL)
+
+                # A desk within a fraction of a mm of the target never starts moving or notifies
+                if not moving and not done.done() and loop.time() > grace_deadline:
+                    done.set_result(current_height)
+
+        self._height_listeners.append(callback)
+        try:
+            await self.wake_up()
+            await asyncio.wait_for(push_target(), timeout=self.config.movement_timeout)
+        except asyncio.TimeoutError:
+            if moving:
+                log("Timed out while waiting for the desk to reach the target height")
+        finally:
+            self._height_listeners.remove(callback)
 
-        while current_height < target:
-            await self.move_to_target(target)
-            await asyncio.sleep(1)
-            height, speed = await self.get_height_speed()
-            log(
-                "Height: {:4.0f}mm Speed: {:2.0f}mm/s".format(
-                    self.unit_converter.raw_to_mm(height), self.unit_converter.raw_to_speed(speed)
-                )
-            )
+        if not moving:
+            return current_height
 
-            # if speed == 0:
-            #     break
+        # The last notification during a move often differs from the height at rest, so read it once
+        self.last_state = await self.get_height_speed()
+        return self.last_state[0]
 
     async def connect(self):
         """Attempt to connect to the desk"""
         try:
-            print("Connecting\r", end="")
+            print_status("Connecting")
             if not self.client:
-                self.client = BleakClient(self.config["mac_address"], device=self.config["adapter_name"])
-            await self.client.connect(timeout=self.config["connection_timeout"])
-            print("Connected {}".format(self.config["mac_address"]))
+                self.client = BleakClient(self.config.mac_address, device=self.config.adapter_name)
+            await self.client.connect(timeout=self.config.connection_timeout)
+            print("Connected {}".format(self.config.mac_address))
 
-            if self.config["debug"]:
+            # Notifications only arrive on changes, so read the current state once and then keep it updated.
+            # Subscribing here also re-arms the subscription whenever the server reconnects.
+            self.last_state = await self.get_height_speed()
+            await self.subscribe(UUID_HEIGHT, self._persistent_cb)
+
+            if self.config.debug:
                 print("Received the services:")
                 for s in self.client.services.services.values():
                     print(f"{s.uuid}:")
@@ -143,46 +216,57 @@ class BluetoothAdapter:
         if self.client.is_connected:
             await self.client.disconnect()
 
-    async def run_command(self, config: Union[dict, UserConfig] = None, log=print):
+    async def run_command(self, config: Optional[FrozenConfig] = None, log=print):
         """Begin the action specified by command line arguments and config"""
 
         if config is None:
             config = self.config
 
         # Always print current height
-        initial_height, speed = await self.get_height_speed()
+        initial_height, speed = self.last_state
         log("Height: {:4.0f}mm".format(self.unit_converter.raw_to_mm(initial_height)))
 
-        target = None
-        if config.get("watch"):
+        if config.watch:
             # Print changes to height data
             log("Watching for changes to desk height and speed")
-            await self.subscribe(
-                GattCharacteristics.UUID_HEIGHT, partial(self.get_height_data_from_notification)
-            )
-            wait = asyncio.get_event_loop().create_future()
-            await wait
-        elif config.get("move_to"):
-            move_target: Union[str, int] = config["move_to"]
+            callback = _make_notify_cb(self.unit_converter.raw_to_mm, self.unit_converter.raw_to_speed, log)
+
+            # Watch until terminated, SIGTERM stops watching so the connection is closed cleanly
+            stop_event = asyncio.Event()
+            loop = asyncio.get_running_loop()
+            try:
+                loop.add_signal_handler(signal.SIGTERM, stop_event.set)
+                handles_sigterm = True
+            except NotImplementedError:
+                # Signal handlers are not available on Windows, rely on KeyboardInterrupt there
+                handles_sigterm = False
+
+            self._height_listeners.append(callback)
+            try:
+                await stop_event.wait()
+            finally:
+                self._height_listeners.remove(callback)
+                if handles_sigterm:
+                    loop.remove_signal_handler(signal.SIGTERM)
+        elif config.move_to:
+            move_target: Union[str, int] = config.move_to
 
             # Move to custom height
-            favourite_value = config.get("favourites", {}).get(move_target)
+            favourite_value = (config.favourites or {}).get(move_target)
             if favourite_value:
                 target = self.unit_converter.mm_to_raw(favourite_value)
                 log(f'Moving to favourite height: {move_target}')
             else:
                 try:
                     target = self.unit_converter.mm_to_raw(int(move_target))
-                    log(f'Moving to height: {config["move_to"]}')
+                    log(f'Moving to height: {config.move_to}')
                 except ValueError:
                     log(f'Not a valid height or favourite position: {move_target}')
                     return
 
-            await self.move_to(target)
+            final_height = await self.move_to(target, log, initial_height)
 
-        if target:
-            final_height, speed = await self.get_height_speed()
-            # If we were moving to a target height, wait, then print the actual final height
+            # If we were moving to a target height, print the actual final height
             log(
                 "Final height: {:4.0f}mm (Target: {:4.0f}mm)".format(
                     self.unit_converter.raw_to_mm(final_height), self.unit_converter.raw_to_mm(target)
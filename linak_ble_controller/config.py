@@ -1,11 +1,17 @@
 import os
 import shutil
 import sys
-from typing import Dict, Union
+from typing import Dict, NamedTuple, Optional, Union
 
 import yaml
 from appdirs import user_config_dir
 
+try:
+    # Use the libyaml bindings if PyYAML was built with them
+    from yaml import CSafeLoader as _Loader
+except ImportError:
+    from yaml import SafeLoader as _Loader
+
 DEFAULT_CONFIG_DIR = user_config_dir("linak-controller")
 DEFAULT_CONFIG_PATH = os.path.join(DEFAULT_CONFIG_DIR, "config.yaml")
 
@@ -23,11 +29,36 @@ DEFAULT_CONFIG = {
 }
 
 
+class FrozenConfig(NamedTuple):
+    """Validated, read-only config with attribute access to every option"""
+
+    mac_address: str
+    base_height: int
+    movement_range: int
+    adapter_name: str
+    scan_timeout: int
+    connection_timeout: int
+    movement_timeout: int
+    server_address: str
+    server_port: int
+    favourites: dict
+    config: str
+    forward: bool
+    debug: bool
+    watch: bool
+    move_to: Optional[Union[str, int]]
+    scan_adapter: bool
+    server: bool
+    tcp_server: bool
+
+
 class UserConfig:
+    __slots__ = ("config",)
+
     def __init__(self, args: Dict[str, Union[str, dict, int, None]]):
         self._copy_default_config()
 
-        self.config = DEFAULT_CONFIG
+        self.config = dict(DEFAULT_CONFIG)
 
         config_path = os.path.join(args["config"])
         if config_path and os.path.isfile(config_path):
@@ -49,7 +80,7 @@ class UserConfig:
     def _read_custom_file(self, path):
         with open(path, "r") as stream:
             try:
-                config_file = yaml.safe_load(stream)
+                config_file = yaml.load(stream, Loader=_Loader)
             except yaml.YAMLError as e:
                 print("Reading config.yaml failed:")
                 print(e)
@@ -58,7 +89,9 @@ class UserConfig:
         self.config.update(config_file)
 
     def _validate_config(self):
-        if not self.config["mac_address"]:
+        # Forwarding and scanning don't talk to the desk directly
+        needs_desk = not (self.config.get("forward") or self.config.get("scan_adapter"))
+        if needs_desk and not self.config["mac_address"]:
             self._log_error("Mac address must be provided")
 
         if "sit_height_offset" in self.config:
@@ -66,7 +99,6 @@ class UserConfig:
                 self._log_error(
                     "Sit height offset must be within [0, {}]".format(self.config["movement_range"])
                 )
-            self.config["sit_height"] = self.config["base_height"] + self.config["sit_height_offset"]
 
         if "stand_height_offset" in self.config:
             if not (0 <= self.config["stand_height_offset"] <= self.config["movement_range"]):
@@ -75,25 +107,20 @@ class UserConfig:
                         self.config["movement_range"]
                     )
                 )
-            self.config["stand_height"] = self.config["base_height"] + self.config["stand_height_offset"]
 
-        self.config["mac_address"] = self.config["mac_address"].upper()
+        # May be left blank for --scan and --forward
+        self.config["mac_address"] = (self.config["mac_address"] or "").upper()
 
         if sys.platform == "win32":
             # Windows doesn't use this parameter so rename it, so it looks nice for the logs
             self.config["adapter_name"] = "default adapter"
 
+    def finalize(self) -> FrozenConfig:
+        """Validate the config and freeze it, options that were not given are None"""
+        self._validate_config()
+        return FrozenConfig(**{field: self.config.get(field) for field in FrozenConfig._fields})
+
     @staticmethod
     def _log_error(message):
         print(message)
         exit(1)
-
-    def __getitem__(self, item) -> Union[int, str, dict, None]:
-        return self.config[item]
-
-    def __contains__(self, item):
-        return self.config.__contains__(item)
-
-    def get(self, __key, default=None):
-        return self.config.get(__key, default)
-
@@ -2,22 +2,48 @@ import asyncio
 import json
 import traceback
 from concurrent.futures import CancelledError
-from functools import partial
+from typing import Optional
 
 import aiohttp
 from aiohttp import web
 
 from linak_ble_controller.bluetooth import BluetoothAdapter
-from linak_ble_controller.config import UserConfig
-from linak_ble_controller.helper import CustomArgumentParser, UnitConverter
+from linak_ble_controller.config import FrozenConfig, UserConfig
+from linak_ble_controller.helper import UnitConverter, get_argument_parser, print_status
+
+try:
+    # Optional faster event loop, not available on Windows
+    import uvloop
+except ImportError:
+    uvloop = None
+
+try:
+    # Optional faster json codec, payloads stay text so plain json clients and servers still work
+    import orjson
+
+    json_loads = orjson.loads
+
+    def json_dumps(obj) -> str:
+        return orjson.dumps(obj).decode("utf8")
+
+except ImportError:
+    json_loads = json.loads
+    json_dumps = json.dumps
+
+# Config keys a client is allowed to override on the server
+FORWARDED_KEYS = ("move_to",)
 
 
 class LinakController:
     def __init__(self):
-        self.argument_parser = CustomArgumentParser()
-        self.user_config = UserConfig(self.argument_parser.get_parsed_args())
-        self.unit_converter = UnitConverter(self.user_config["base_height"])
+        self.argument_parser = get_argument_parser()
+        self.user_config = UserConfig(self.argument_parser.get_parsed_args()).finalize()
+        self.unit_converter = UnitConverter(self.user_config.base_height)
         self.bluetooth_adapter = BluetoothAdapter(self.unit_converter, self.user_config)
+        self._session: Optional[aiohttp.ClientSession] = None
+
+        if uvloop is not None:
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 
         try:
             asyncio.run(self.run())
@@ -27,17 +53,17 @@ class LinakController:
     async def run(self):
         try:
             # Forward and scan don't require a connection so run them and exit
-            if self.user_config["forward"]:
+            if self.user_config.forward:
                 await self.forward_command()
-            elif self.user_config["scan_adapter"]:
+            elif self.user_config.scan_adapter:
                 await self.bluetooth_adapter.scan()
             else:
                 # Server and other commands do require a connection so set one up
-                client = await self.bluetooth_adapter.connect()
-                if self.user_config["server"]:
+                await self.bluetooth_adapter.connect()
+                if self.user_config.server:
                     await self.run_server()
-                elif self.user_config.config["tcp_server"]:
-                    await self.run_tcp_server(client, self.user_config)
+                elif self.user_config.tcp_server:
+                    await self.run_tcp_server()
                 else:
                     await self.bluetooth_adapter.run_command()
         except (KeyboardInterrupt, CancelledError):
@@ -46,13 +72,15 @@ class LinakController:
             print(f"\nSomething unexpected went wrong: {e}")
             print(traceback.format_exc())
         finally:
+            if self._session:
+                await self._session.close()
             if self.bluetooth_adapter.client:
-                print("\rDisconnecting\r", end="")
+                print_status("Disconnecting")
                 await self.bluetooth_adapter.stop()
                 await self.bluetooth_adapter.disconnect()
                 print("Disconnected!")
 
-    async def run_tcp_server(self, client, config):
+    async def run_tcp_server(self):
         """Start a simple tcp server to listen for commands"""
 
         def disconnect_callback(_=None):
@@ -61,9 +89,9 @@ class LinakController:
 
         self.bluetooth_adapter.client.set_disconnected_callback(disconnect_callback)
         server = await asyncio.start_server(
-            partial(self.run_tcp_forwarded_command, client, config),
-            self.user_config["server_address"],
-            self.user_config["server_port"],
+            self.run_tcp_forwarded_command,
+            self.user_config.server_address,
+            self.user_config.server_port,
         )
         print("TCP Server listening")
         await server.serve_forever()
@@ -71,12 +99,15 @@ class LinakController:
     async def run_tcp_forwarded_command(self, reader, writer):
         """Run commands received by the tcp server"""
         print("Received command")
-        request = (await reader.read()).decode("utf8")
-        forwarded_config = json.loads(str(request))
-        merged_config = {**self.user_config.config, **forwarded_config}
-        await self.bluetooth_adapter.run_command(merged_config)
+        forwarded_config = json_loads(await reader.read())
+        await self.bluetooth_adapter.run_command(self._merge_forwarded_config(forwarded_config))
         writer.close()
 
+    def _merge_forwarded_config(self, forwarded_config: dict) -> FrozenConfig:
+        """Overlay the allowed forwarded keys on the server config"""
+        overrides = {key: forwarded_config[key] for key in FORWARDED_KEYS if key in forwarded_config}
+        return self.user_config._replace(**overrides)
+
     async def run_server(self):
         """Start a server to listen for commands via websocket connection"""
 
@@ -87,10 +118,10 @@ class LinakController:
         self.bluetooth_adapter.client.set_disconnected_callback(disconnect_callback)
 
         app = web.Application()
-        app.router.add_get("/", partial(self.run_forwarded_command, self.bluetooth_adapter.client))
+        app.router.add_get("/", self.run_forwarded_command)
         runner = web.AppRunner(app)
         await runner.setup()
-        site = web.TCPSite(runner, self.user_config["server_address"], self.user_config["server_port"])
+        site = web.TCPSite(runner, self.user_config.server_address, self.user_config.server_port)
         await site.start()
         print("Server listening")
         while True:
@@ -107,24 +138,33 @@ class LinakController:
 
         await ws.prepare(request)
         async for msg in ws:
-            if msg.type == aiohttp.WSMsgType.TEXT:
-                forwarded_config = json.loads(msg.data)
-                merged_config = {**self.user_config.config, **forwarded_config}
-                await self.bluetooth_adapter.run_command(merged_config, log)
+            if msg.type in (aiohttp.WSMsgType.TEXT, aiohttp.WSMsgType.BINARY):
+                forwarded_config = json_loads(msg.data)
+                await self.bluetooth_adapter.run_command(self._merge_forwarded_config(forwarded_config), log)
             break
         await asyncio.sleep(1)  # Allows final messages to send on web socket
         await ws.close()
         return ws
 
+    def _get_session(self) -> aiohttp.ClientSession:
+        """Create the http session on first use so its connection pool is reused by later forwards"""
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=4, keepalive_timeout=30)
+            )
+        return self._session
+
     async def forward_command(self):
         """Send commands to a server instance of this script"""
-        allowed_keys = ["move_to"]
-        forwarded_config = {key: self.user_config[key] for key in allowed_keys if key in self.user_config}
-        session = aiohttp.ClientSession()
-        ws = await session.ws_connect(
-            f'http://{self.user_config["server_address"]}:{self.user_config["server_port"]}'
+        forwarded_config = {
+            key: getattr(self.user_config, key)
+            for key in FORWARDED_KEYS
+            if getattr(self.user_config, key) is not None
+        }
+        ws = await self._get_session().ws_connect(
+            f'http://{self.user_config.server_address}:{self.user_config.server_port}'
         )
-        await ws.send_str(json.dumps(forwarded_config))
+        await ws.send_str(json_dumps(forwarded_config))
         while True:
             msg = await ws.receive()
             if msg.type == aiohttp.WSMsgType.text:
@@ -132,5 +172,4 @@ class LinakController:
             elif msg.type in [aiohttp.WSMsgType.closed, aiohttp.WSMsgType.error]:
                 break
         await ws.close()
-        await session.close()
 
@@ -1,8 +1,16 @@
+import sys
 from argparse import ArgumentParser
+from functools import lru_cache
 
 from linak_ble_controller.config import DEFAULT_CONFIG_PATH
 
 
+def print_status(message: str):
+    """Print a transient status line to stderr that the next output overwrites"""
+    sys.stderr.write(f"\r{message}\r")
+    sys.stderr.flush()
+
+
 class CustomArgumentParser(ArgumentParser):
     def __init__(self):
         super().__init__()
@@ -113,16 +121,19 @@ class CustomArgumentParser(ArgumentParser):
         return {k: v for k, v in vars(self.parse_args()).items() if v is not None}
 
 
+@lru_cache(maxsize=None)
+def get_argument_parser() -> CustomArgumentParser:
+    """Build the argument parser once and reuse it"""
+    return CustomArgumentParser()
+
+
 class UnitConverter:
+    __slots__ = ("base_height", "mm_to_raw", "raw_to_mm", "raw_to_speed")
+
     def __init__(self, base_height: int):
         self.base_height = base_height
 
-    def mm_to_raw(self, mm):
-        return (mm - self.base_height) * 10
-
-    def raw_to_mm(self, raw):
-        return (raw / 10) + self.base_height
-
-    @staticmethod
-    def raw_to_speed(raw):
-        return raw / 100
+        # Bound as plain functions with the base height captured, so callers skip method dispatch
+        self.mm_to_raw = lambda mm, b=base_height: (mm - b) * 10
+        self.raw_to_mm = lambda raw, b=base_height: (raw / 10) + b
+        self.raw_to_speed = lambda raw: raw / 100